@@ -3,23 +3,133 @@
 ##### Uniqname: bulgan
 #################################
 
-from bs4 import BeautifulSoup
+import lxml.html
 import requests
+from requests.adapters import HTTPAdapter
+import asyncio
 import json
+import os
+import sqlite3
 import time
+import zlib
+import atexit
+import threading
+from urllib.parse import urlencode, urlparse
+from concurrent.futures import ThreadPoolExecutor
 import secrets # file that contains your API key
 
+try:
+    from orjson import dumps as json_dumps, loads as json_loads
+except ImportError:
+    # orjson is optional; fall back to the stdlib with the same bytes interface
+    def json_dumps(obj):
+        return json.dumps(obj).encode('utf-8')
+    json_loads = json.loads
+
+try:
+    import aiohttp
+except ImportError:
+    # aiohttp is optional; without it state pages are only fetched on demand
+    aiohttp = None
+
 api_key = secrets.API_KEY
 
 BASE_URL = 'https://www.nps.gov'
 STATES_INDEX_PATH = '/index.htm'
-CACHE_FILE_NAME = 'nps_cache.json'
+CACHE_FILE_NAME = 'nps_cache.db'
 CACHE_DICT = {}
+CACHE_COMPRESS_LEVEL = 1
+REQUEST_TIMEOUT = 10
+MAX_WORKERS = 8
+MIN_FETCH_INTERVAL = 0.25
+LAST_FETCH_PER_HOST = {}
+THROTTLE_LOCK = threading.Lock()
+PARSED_KEY_PREFIX = 'parsed::'
+MAPQUEST_URL = 'http://www.mapquestapi.com/search/v2/radius'
+NEARBY_URLS = {}
+PREFETCH_STATES = 10
+PREFETCH_CONNECTIONS = 16
+PARSERS = threading.local()
+
+SESSION = requests.Session()
+SESSION.mount('https://', HTTPAdapter(pool_connections=16, pool_maxsize=32))
+SESSION.mount('http://', HTTPAdapter(pool_connections=16, pool_maxsize=32))
+
+STATE_LINK_XPATH = ('(//*[@class="dropdown-menu SearchBar-keywordSearch"])[1]'
+                    '//li/descendant::a[1]')
+PARK_PATH_XPATH = ('//div[@class="col-md-9 col-sm-9 col-xs-12 table-cell list_left"]'
+                   '/descendant::a[1]/@href')
+SITE_CLASSES = ('Hero-title', 'Hero-designation')
+SITE_ITEMPROPS = ('addressLocality', 'addressRegion', 'postalCode', 'telephone')
+SITE_FIELDS_XPATH = ('//*[contains(concat(" ", normalize-space(@class), " "), " Hero-title ")'
+                     ' or contains(concat(" ", normalize-space(@class), " "), " Hero-designation ")'
+                     ' or (self::span and (@itemprop="addressLocality" or @itemprop="addressRegion"'
+                     ' or @itemprop="postalCode" or @itemprop="telephone"))]')
+
+_MISSING = object()
+
+class SqliteCache:
+    '''a key-value cache stored in a sqlite database
+
+    Values are JSON-encoded and zlib-compressed, so anything json_dumps
+    accepts can be stored.
+    Writes stay in an open transaction until commit() is called.
+    All access goes through one lock so the cache can be shared by threads.
+    '''
+    def __init__(self, filename):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(filename, check_same_thread=False)
+        try:
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('PRAGMA synchronous=NORMAL')
+            # DDL runs outside a transaction, so the table exists once this returns
+            self._conn.execute('CREATE TABLE IF NOT EXISTS cache(k TEXT PRIMARY KEY, v BLOB)')
+        except sqlite3.Error:
+            self._conn.close()
+            raise
+
+
+    def __contains__(self, key):
+        with self._lock:
+            row = self._conn.execute('SELECT 1 FROM cache WHERE k = ?', (key,)).fetchone()
+        return row is not None
+
+
+    def __getitem__(self, key):
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
+
+
+    def get(self, key, default=None):
+        with self._lock:
+            row = self._conn.execute('SELECT v FROM cache WHERE k = ?', (key,)).fetchone()
+        if row is None:
+            return default
+        return json_loads(zlib.decompress(row[0]))
+
+
+    def __setitem__(self, key, value):
+        blob = zlib.compress(json_dumps(value), CACHE_COMPRESS_LEVEL)
+        with self._lock:
+            self._conn.execute('INSERT OR REPLACE INTO cache(k, v) VALUES (?, ?)', (key, blob))
+
+
+    def commit(self):
+        with self._lock:
+            self._conn.commit()
+
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
 
 def open_cache():
-    ''' Opens the cache file if it exists and loads the JSON into
-    the CACHE_DICT dictionary.
-    if the cache file doesn't exist, creates a new cache dictionary
+    ''' Opens the cache database, creating it if it doesn't exist.
+    if the cache file can't be read as a database, replaces it
+    with a new empty cache
 
     Parameters
     ----------
@@ -27,34 +137,88 @@ def open_cache():
 
     Returns
     -------
-    The opened cache: dict
+    The opened cache: SqliteCache
     '''
     try:
-        cache_file = open(CACHE_FILE_NAME, 'r')
-        cache_file_contents = cache_file.read()
-        cache = json.loads(cache_file_contents)
-        cache_file.close()
-    except:
-        cache = {}
-    return cache
+        return SqliteCache(CACHE_FILE_NAME)
+    except sqlite3.DatabaseError:
+        print(f"Cache file {CACHE_FILE_NAME} is unreadable, starting a new one")
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(CACHE_FILE_NAME + suffix):
+                os.remove(CACHE_FILE_NAME + suffix)
+        return SqliteCache(CACHE_FILE_NAME)
 
 
 def save_cache(cache):
-    ''' Saves the current state of the cache to disk
+    ''' Commits the pending writes of the cache to disk
+
+    Parameters
+    ----------
+    cache: SqliteCache
+        The cache to save
+
+    Returns
+    -------
+    None
+    '''
+    cache.commit()
+
+
+def flush_cache():
+    ''' Saves CACHE_DICT to disk
+
+    Parameters
+    ----------
+    None
+
+    Returns
+    -------
+    None
+    '''
+    save_cache(CACHE_DICT)
+
+
+def reserve_fetch_slot(url):
+    ''' Claims the next free fetch slot for the url's host, keeping
+    live fetches to a host at least MIN_FETCH_INTERVAL seconds apart
+
+    Parameters
+    ----------
+    url: string
+        The URL about to be fetched
+
+    Returns
+    -------
+    float
+        the number of seconds to wait before fetching
+    '''
+    host = urlparse(url).netloc
+    with THROTTLE_LOCK:
+        now = time.monotonic()
+        last_fetch = LAST_FETCH_PER_HOST.get(host, now - MIN_FETCH_INTERVAL)
+        delay = max(0, last_fetch + MIN_FETCH_INTERVAL - now)
+        # reserve this slot before waiting so other fetches queue behind it
+        LAST_FETCH_PER_HOST[host] = now + delay
+    return delay
+
+
+def wait_for_host(url):
+    ''' Sleeps until the fetch slot reserved for the url's host is due.
+    Slots are shared with the async prefetcher, so fetches from worker
+    threads and from prefetch_states are all spaced out together.
 
     Parameters
     ----------
-    cache_dict: dict
-        The dictionary to save
+    url: string
+        The URL about to be fetched
 
     Returns
     -------
     None
     '''
-    cache_file = open(CACHE_FILE_NAME, 'w')
-    contents_to_write = json.dumps(cache)
-    cache_file.write(contents_to_write)
-    cache_file.close()
+    delay = reserve_fetch_slot(url)
+    if delay:
+        time.sleep(delay)
 
 
 def make_url_request_using_cache(url, cache):
@@ -65,8 +229,8 @@ def make_url_request_using_cache(url, cache):
     ----------
     url: string
         The URL for the API endpoint
-    cache: cache
-        A dictionary of the cache
+    cache: SqliteCache
+        The cache to look the url up in
 
     Returns
     -------
@@ -74,18 +238,40 @@ def make_url_request_using_cache(url, cache):
         the data returned from making the request in the form of
         a dictionary
     '''
-    if (url in cache.keys()): # the url is our unique key
+    cached = cache.get(url) # the url is our unique key
+    if cached is not None:
         print("Using cache")
-        return cache[url]
-    else:
-        print("Fetching")
-        time.sleep(1)
-        response = requests.get(url)
-        cache[url] = response.text
-        save_cache(cache)
-        return cache[url]
+        return cached
+    print("Fetching")
+    wait_for_host(url)
+    response = SESSION.get(url, timeout=REQUEST_TIMEOUT)
+    cache[url] = response.text
+    return response.text
 
 CACHE_DICT = open_cache()
+atexit.register(flush_cache)
+
+
+def get_html_parser():
+    ''' Returns the lxml HTML parser of the current thread,
+    creating it on first use. lxml parsers can be reused across
+    documents but not shared between threads.
+
+    Parameters
+    ----------
+    None
+
+    Returns
+    -------
+    lxml.html.HTMLParser
+        the parser for this thread
+    '''
+    parser = getattr(PARSERS, 'parser', None)
+    if parser is None:
+        parser = lxml.html.HTMLParser()
+        PARSERS.parser = parser
+    return parser
+
 
 class NationalSite:
     '''a national site
@@ -108,6 +294,8 @@ class NationalSite:
     phone: string
         the phone of a national site (e.g. '(616) 319-7906', '307-344-7381')
     '''
+    __slots__ = ('category', 'name', 'address', 'zipcode', 'phone')
+
     def __init__(self, category, name, address, zipcode, phone):
         self.category = category
         self.name = name
@@ -135,22 +323,81 @@ def build_state_url_dict():
     '''
     index_url = BASE_URL + STATES_INDEX_PATH
     index_text = make_url_request_using_cache(index_url, CACHE_DICT)
-    soup = BeautifulSoup(index_text, 'html.parser')
-
+    index_tree = lxml.html.fromstring(index_text, parser=get_html_parser())
 
     states_dict = {}
 
-    states_dropdown = soup.find(class_='dropdown-menu SearchBar-keywordSearch')
-    states_list = states_dropdown.find_all('li')
-
-    for state in states_list:
-        state_link_tag = state.find('a')
-        state_url_path = state_link_tag['href']
+    for state_link_tag in index_tree.xpath(STATE_LINK_XPATH):
+        state_url_path = state_link_tag.get('href')
         state_url = BASE_URL + state_url_path
-        state_name = state_link_tag.text.strip().lower()
+        state_name = state_link_tag.text_content().strip().lower()
         states_dict[state_name] = state_url
+    flush_cache()
     return states_dict
 
+async def prefetch_states(urls):
+    '''Download the state pages that are not cached yet and
+    store them in CACHE_DICT. Fetches take their slots from
+    reserve_fetch_slot, so they follow the same per-host throttle
+    as make_url_request_using_cache.
+
+    Parameters
+    ----------
+    urls: list
+        The URLs of the state pages to prefetch
+
+    Returns
+    -------
+    None
+    '''
+    missing_urls = [url for url in urls if url not in CACHE_DICT]
+    if not missing_urls:
+        return
+
+    connector = aiohttp.TCPConnector(limit=PREFETCH_CONNECTIONS)
+    timeout = aiohttp.ClientTimeout(total=REQUEST_TIMEOUT)
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        async def fetch(url):
+            delay = reserve_fetch_slot(url)
+            if delay:
+                await asyncio.sleep(delay)
+            try:
+                async with session.get(url) as response:
+                    if response.status == 200:
+                        CACHE_DICT[url] = await response.text()
+            except (aiohttp.ClientError, asyncio.TimeoutError, UnicodeDecodeError, sqlite3.Error):
+                pass # the page is fetched again when the user asks for it
+        await asyncio.gather(*(fetch(url) for url in missing_urls))
+
+    try:
+        save_cache(CACHE_DICT)
+    except sqlite3.Error:
+        pass # the pages are committed with the next save instead
+
+
+def start_prefetch(states_dict):
+    '''Start prefetching the first PREFETCH_STATES state pages
+    in a background thread while the user is at the prompt.
+    Does nothing when aiohttp is not installed.
+
+    Parameters
+    ----------
+    states_dict: dict
+        The state name to state page url mapping from build_state_url_dict
+
+    Returns
+    -------
+    Thread or None
+        the background thread, if one was started
+    '''
+    if aiohttp is None:
+        return None
+    urls = list(states_dict.values())[:PREFETCH_STATES]
+    thread = threading.Thread(target=asyncio.run, args=(prefetch_states(urls),), daemon=True)
+    thread.start()
+    return thread
+
+
 def construct_unique_key(baseurl, params):
     ''' constructs a key that is guaranteed to uniquely and
     repeatably identify an API request by its baseurl and params
@@ -171,15 +418,9 @@ def construct_unique_key(baseurl, params):
     string
         the unique key as a string
     '''
-
-
-    param_strings = []
     connector = '_'
-    for k in params.keys():
-        param_strings.append(f'{k}_{params[k]}')
-    param_strings.sort()
-    unique_key = baseurl + connector +  connector.join(param_strings)
-    return unique_key
+    param_strings = sorted(f'{k}_{v}' for k, v in params.items())
+    return baseurl + connector + connector.join(param_strings)
 
 def get_site_instance(site_url):
     '''Make an instances from a national site URL.
@@ -194,25 +435,42 @@ def get_site_instance(site_url):
     instance
         a national site instance
     '''
+    #reuse the fields parsed on an earlier run if we have them
+    parsed_key = PARSED_KEY_PREFIX + site_url
+    parsed = CACHE_DICT.get(parsed_key)
+    if parsed is not None:
+        return NationalSite(**parsed)
     #get the site page html
     site_text = make_url_request_using_cache(site_url, CACHE_DICT)
-    site_soup = BeautifulSoup(site_text, 'html.parser')
+    site_tree = lxml.html.fromstring(site_text, parser=get_html_parser())
+    #collect every field node in one pass, keeping the first match of each
+    fields = {}
+    for node in site_tree.xpath(SITE_FIELDS_XPATH):
+        itemprop = node.get('itemprop')
+        if itemprop in SITE_ITEMPROPS:
+            keys = [itemprop]
+        else:
+            keys = [c for c in node.get('class', '').split() if c in SITE_CLASSES]
+        for key in keys:
+            fields.setdefault(key, node.text_content().strip())
     #extract the site information
-    site_name = site_soup.find(class_='Hero-title').text.strip()
-    site_category = site_soup.find(class_='Hero-designation').text.strip()
-    try:
-        site_city = site_soup.find('span', itemprop='addressLocality').text.strip()
-        site_state = site_soup.find('span', itemprop='addressRegion').text.strip()
-        site_address = site_city + ', ' + site_state
-    except:
+    site_name = fields['Hero-title']
+    site_category = fields['Hero-designation']
+    if 'addressLocality' in fields and 'addressRegion' in fields:
+        site_address = fields['addressLocality'] + ', ' + fields['addressRegion']
+    else:
         site_address = 'No address'
-    try:
-        site_zip = site_soup.find('span', itemprop='postalCode').text.strip()
-    except:
-        site_zip = 'No zipcode'
-    site_phone = site_soup.find('span', itemprop='telephone').text.strip()
+    site_zip = fields.get('postalCode', 'No zipcode')
+    site_phone = fields['telephone']
     #create the national site instance
     site_instance = NationalSite(site_category, site_name, site_address, site_zip,site_phone)
+    CACHE_DICT[parsed_key] = {
+        'category': site_category,
+        'name': site_name,
+        'address': site_address,
+        'zipcode': site_zip,
+        'phone': site_phone,
+    }
     return site_instance
 
 
@@ -229,18 +487,15 @@ def get_sites_for_state(state_url):
     list
         a list of national site instances
     '''
-    list_of_sites = []
-
     state_text = make_url_request_using_cache(state_url, CACHE_DICT)
-    state_soup = BeautifulSoup(state_text, 'html.parser')
-
-    parks = state_soup.find_all('div', class_='col-md-9 col-sm-9 col-xs-12 table-cell list_left')
-    for park in parks:
-        park_link_tag = park.find('a')
-        park_path = park_link_tag['href']
-        park_url = BASE_URL + park_path
-        site_instance = get_site_instance(park_url)
-        list_of_sites.append(site_instance)
+    state_tree = lxml.html.fromstring(state_text, parser=get_html_parser())
+
+    park_urls = [BASE_URL + park_path for park_path in state_tree.xpath(PARK_PATH_XPATH)]
+
+    # the site pages are independent, so fetch them concurrently
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        list_of_sites = list(executor.map(get_site_instance, park_urls))
+    flush_cache()
     return list_of_sites
 
 
@@ -257,28 +512,31 @@ def get_nearby_places(site_object):
     dict
         a converted API return from MapQuest API
     '''
-    params = {
-    'key': secrets.API_KEY,
-    'origin': site_object.zipcode,
-    'radius': 10,
-    'units': 'm',
-    'maxMatches': 10,
-    'ambiguities': 'ignore',
-    'outFormat': 'json'
-}
-    CACHE_DICT = open_cache()
-
-    mapquest_url = 'http://www.mapquestapi.com/search/v2/radius'
-
-    uniq_key = construct_unique_key(mapquest_url, params)
-    if uniq_key in CACHE_DICT.keys():
+    # the full request url doubles as the cache key, so build it once per zipcode
+    nearby_url = NEARBY_URLS.get(site_object.zipcode)
+    if nearby_url is None:
+        params = {
+            'key': secrets.API_KEY,
+            'origin': site_object.zipcode,
+            'radius': 10,
+            'units': 'm',
+            'maxMatches': 10,
+            'ambiguities': 'ignore',
+            'outFormat': 'json'
+        }
+        nearby_url = f"{MAPQUEST_URL}?{urlencode(sorted(params.items()))}"
+        NEARBY_URLS[site_object.zipcode] = nearby_url
+
+    cached = CACHE_DICT.get(nearby_url)
+    if cached is not None:
         print('Using Cache')
-        return CACHE_DICT[uniq_key]
+        return cached
     else:
         print('Fetching')
-        CACHE_DICT[uniq_key] = requests.get(mapquest_url, params=params).json()
+        response = SESSION.get(nearby_url, timeout=REQUEST_TIMEOUT).json()
+        CACHE_DICT[nearby_url] = response
         save_cache(CACHE_DICT)
-        return CACHE_DICT[uniq_key]
+        return response
 
 
 def formatted_nearby_places(api_resp):
@@ -297,20 +555,15 @@ def formatted_nearby_places(api_resp):
     '''
 
     results = api_resp['searchResults']
-    for i in range(len(results)):
-        name = results[i]['fields']['name']
-        if results[i]['fields']['group_sic_code_ext']:
-            category = results[i]['fields']['group_sic_code_name_ext']
+    for result in results:
+        fields = result['fields']
+        name = fields['name']
+        if fields.get('group_sic_code_ext'):
+            category = fields['group_sic_code_name_ext']
         else:
             category = 'no category'
-        if results[i]['fields']['address']:
-            address = results[i]['fields']['address']
-        else:
-            address = 'no address'
-        if results[i]['fields']['city']:
-            city = results[i]['fields']['city']
-        else:
-            city = 'no city'
+        address = fields.get('address') or 'no address'
+        city = fields.get('city') or 'no city'
         print(f"- {name} ({category}): {address}, {city}")
 
 
@@ -335,19 +588,20 @@ def print_state_sites(state, sites_list):
     print('-' * 50)
     print(f"List of national sites in {state.title()}")
     print('-' * 50)
-    for x in sites_list:
-        # print(sites_list.index(x)+1, x.info())
-        print(f"[{sites_list.index(x)+1}]", x.info())
+    for i, x in enumerate(sites_list, start=1):
+        print(f"[{i}]", x.info())
 
 
 if __name__ == "__main__":
     # user_input = input("Enter a state name (e.g. Michigan, michigan), or 'exit' to quit: ").lower()
     states_dict = build_state_url_dict()
+    state_names = frozenset(states_dict)
+    start_prefetch(states_dict)
     while True:
-        user_input = input("Enter a state name (e.g. Michigan, michigan), or 'exit' to quit: ").lower()
+        user_input = input("Enter a state name (e.g. Michigan, michigan), or 'exit' to quit: ").strip().lower()
         if user_input == 'exit':
             break
-        elif user_input in states_dict.keys():
+        elif user_input in state_names:
             # states_dict = build_state_url_dict()
             user_input_state_url = states_dict[user_input]
             state_sites = get_sites_for_state(user_input_state_url)
@@ -355,7 +609,7 @@ if __name__ == "__main__":
 
             while True:
                 try:
-                    user_input = input("Choose the number for detail search or 'exit' or 'back': ")
+                    user_input = input("Choose the number for detail search or 'exit' or 'back': ").strip()
                     if user_input == 'exit':
                         break
                     elif user_input == 'back':
@@ -1,4 +1,9 @@
+import contextlib
+import io
+import os
+import tempfile
 import unittest
+from unittest import mock
 import proj2_nps as nps
 
 # SI 507 Fall 2020
@@ -84,5 +89,156 @@ class Test_Part4(unittest.TestCase):
         self.assertEqual(self.near_wy['options']['radius'], 10)
 
 
+class Test_Part5(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.db_path = os.path.join(self.tmp_dir.name, 'cache.db')
+        self.cache = nps.SqliteCache(self.db_path)
+
+    def tearDown(self):
+        self.cache.close()
+        self.tmp_dir.cleanup()
+
+    def test_5_1_set_get(self):
+        self.cache['page'] = '<html></html>'
+        self.cache['api'] = {'resultsCount': 10}
+        self.assertIn('page', self.cache)
+        self.assertEqual(self.cache['page'], '<html></html>')
+        self.assertEqual(self.cache.get('api'), {'resultsCount': 10})
+
+    def test_5_2_missing_key(self):
+        self.assertNotIn('nope', self.cache)
+        self.assertIsNone(self.cache.get('nope'))
+        self.assertEqual(self.cache.get('nope', 'default'), 'default')
+        with self.assertRaises(KeyError):
+            self.cache['nope']
+
+    def test_5_3_commit_and_reopen(self):
+        self.cache['page'] = '<html></html>'
+        other = nps.SqliteCache(self.db_path)
+        self.assertNotIn('page', other)
+        other.close()
+
+        self.cache.commit()
+        self.cache.close()
+        self.cache = nps.SqliteCache(self.db_path)
+        self.assertEqual(self.cache['page'], '<html></html>')
+
+
+class Test_Part6(unittest.TestCase):
+    def test_6_1_missing_fields(self):
+        api_resp = {'searchResults': [
+            {'fields': {'name': 'Cafe', 'group_sic_code_ext': '581208',
+                        'group_sic_code_name_ext': 'Restaurants',
+                        'address': '1 Main St', 'city': 'Cody'}},
+            {'fields': {'name': 'Empty', 'group_sic_code_ext': '',
+                        'address': '', 'city': ''}},
+            {'fields': {'name': 'Bare'}},
+        ]}
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            nps.formatted_nearby_places(api_resp)
+        self.assertEqual(output.getvalue().splitlines(), [
+            "- Cafe (Restaurants): 1 Main St, Cody",
+            "- Empty (no category): no address, no city",
+            "- Bare (no category): no address, no city",
+        ])
+
+
+class Test_Part7(unittest.TestCase):
+    def setUp(self):
+        # freeze the clock so each reservation's delay is exact
+        patches = [
+            mock.patch.dict(nps.LAST_FETCH_PER_HOST, clear=True),
+            mock.patch.object(nps, 'MIN_FETCH_INTERVAL', 0.25),
+            mock.patch('proj2_nps.time.monotonic', return_value=100.0),
+            mock.patch('proj2_nps.time.sleep'),
+        ]
+        for patch in patches:
+            self.addCleanup(patch.stop)
+        *_, self.sleep = [patch.start() for patch in patches]
+
+    def test_7_1_same_host_queues(self):
+        self.assertEqual(nps.reserve_fetch_slot('https://www.nps.gov/a'), 0)
+        self.assertEqual(nps.reserve_fetch_slot('https://www.nps.gov/b'), 0.25)
+        self.assertEqual(nps.reserve_fetch_slot('https://www.nps.gov/c'), 0.5)
+
+    def test_7_2_other_host_not_delayed(self):
+        nps.reserve_fetch_slot('https://www.nps.gov/a')
+        self.assertEqual(nps.reserve_fetch_slot('http://www.mapquestapi.com/x'), 0)
+
+    def test_7_3_wait_for_host_sleeps(self):
+        for path in ('a', 'b', 'c'):
+            nps.wait_for_host('https://www.nps.gov/' + path)
+        nps.wait_for_host('http://www.mapquestapi.com/x')
+        self.assertEqual(self.sleep.call_args_list, [mock.call(0.25), mock.call(0.5)])
+
+
+SITE_HTML = """<html><body>
+<div class="Hero-titleContainer clearfix">
+  <a href="/bica/" class="Hero-title -long" id="anch_10">Bighorn Canyon</a>
+  <span class="Hero-designation">National Recreation Area</span>
+</div>
+<p class="adr" itemprop="address">
+  <span itemprop="addressLocality"> Lovell</span>,
+  <span itemprop="addressRegion" class="region">WY</span>
+  <span itemprop="postalCode" class="postal-code">82435 </span>
+</p>
+<span itemprop="telephone" class="tel">(307) 548-5406</span>
+<a class="Hero-title">Not the first title</a>
+</body></html>"""
+
+SITE_HTML_NO_ADDRESS = """<html><body>
+<a class="Hero-title">Somewhere</a>
+<span class="Hero-designation"></span>
+<p class="adr"><span itemprop="addressRegion">WY</span></p>
+<span itemprop="telephone">307-000-0000</span>
+</body></html>"""
+
+
+class Test_Part8(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.cache = nps.SqliteCache(os.path.join(self.tmp_dir.name, 'cache.db'))
+        self.cache['https://www.nps.gov/bica/index.htm'] = SITE_HTML
+        self.cache['https://www.nps.gov/none/index.htm'] = SITE_HTML_NO_ADDRESS
+        cache_patch = mock.patch.object(nps, 'CACHE_DICT', self.cache)
+        cache_patch.start()
+        self.addCleanup(cache_patch.stop)
+
+    def tearDown(self):
+        self.cache.close()
+        self.tmp_dir.cleanup()
+
+    def get_site(self, url):
+        with contextlib.redirect_stdout(io.StringIO()):
+            return nps.get_site_instance(url)
+
+    def test_8_1_fields(self):
+        site = self.get_site('https://www.nps.gov/bica/index.htm')
+        self.assertEqual(site.name, "Bighorn Canyon")
+        self.assertEqual(site.category, "National Recreation Area")
+        self.assertEqual(site.address, "Lovell, WY")
+        self.assertEqual(site.zipcode, "82435")
+        self.assertEqual(site.phone, "(307) 548-5406")
+
+    def test_8_2_defaults(self):
+        site = self.get_site('https://www.nps.gov/none/index.htm')
+        self.assertEqual(site.name, "Somewhere")
+        self.assertEqual(site.category, "")
+        self.assertEqual(site.address, "No address")
+        self.assertEqual(site.zipcode, "No zipcode")
+        self.assertEqual(site.phone, "307-000-0000")
+
+    def test_8_3_parsed_cache(self):
+        url = 'https://www.nps.gov/bica/index.htm'
+        self.get_site(url)
+        self.assertIn(nps.PARSED_KEY_PREFIX + url, self.cache)
+        # a second call must not parse the page again
+        self.cache[url] = SITE_HTML_NO_ADDRESS
+        site = self.get_site(url)
+        self.assertEqual(site.info(), "Bighorn Canyon (National Recreation Area): Lovell, WY 82435")
+
+
 if __name__ == '__main__':
     unittest.main()